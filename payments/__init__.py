@@ -10,9 +10,16 @@ from .gateway import (
     Address,
     Phone,
     Item,
-    AuthenticationMethod
+    AuthenticationMethod,
+    ChargeOperationResult,
+    PagSeguroAPIError
 )
 from .validators import PaymentValidators
+from .deadline import Deadline, DeadlineExceeded
+from .outbox import PaymentOutbox
+from .profiling import PaymentProfiler
+from .registry import PagSeguroClientRegistry
+from .installments import InstallmentSimulator, InstallmentPlan, InstallmentOption
 from .enums import PaymentMethod
 
 __version__ = "0.1.0"
@@ -33,5 +40,15 @@ __all__ = [
     "Phone",
     "Item",
     "AuthenticationMethod",
-    "PaymentValidators"
+    "ChargeOperationResult",
+    "PagSeguroAPIError",
+    "PaymentValidators",
+    "Deadline",
+    "DeadlineExceeded",
+    "PaymentOutbox",
+    "PaymentProfiler",
+    "PagSeguroClientRegistry",
+    "InstallmentSimulator",
+    "InstallmentPlan",
+    "InstallmentOption"
 ]
@@ -0,0 +1,57 @@
+import time
+from datetime import datetime
+from typing import Optional, Union
+
+
+class DeadlineExceeded(Exception):
+    """Prazo da operação esgotado antes da conclusão do pagamento"""
+
+
+class Deadline:
+    """
+    Prazo final de uma operação, medido pelo relógio monotônico.
+
+    Use `Deadline.after(segundos)` para um orçamento de tempo ou `Deadline.at(...)`
+    para um instante absoluto (datetime ou timestamp Unix).
+    """
+
+    def __init__(self, expires_at: float):
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds: float) -> "Deadline":
+        return cls(time.monotonic() + seconds)
+
+    @classmethod
+    def at(cls, when: Union[datetime, float]) -> "Deadline":
+        timestamp = when.timestamp() if isinstance(when, datetime) else float(when)
+        return cls.after(timestamp - time.time())
+
+    @classmethod
+    def resolve(cls, deadline: Optional[Union["Deadline", datetime, float]] = None,
+                timeout: Optional[float] = None) -> Optional["Deadline"]:
+        """Combina um prazo absoluto e um orçamento em segundos, mantendo o mais curto"""
+        candidates = []
+        if deadline is not None:
+            candidates.append(deadline if isinstance(deadline, Deadline) else cls.at(deadline))
+        if timeout is not None:
+            candidates.append(cls.after(timeout))
+        if not candidates:
+            return None
+        return min(candidates, key=lambda d: d.expires_at)
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> float:
+        """Levanta DeadlineExceeded se o prazo acabou; senão retorna o tempo restante"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Prazo esgotado antes {stage} ({-remaining:.3f}s excedidos)")
+        return remaining
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining():.3f}s)"
@@ -1,9 +1,15 @@
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Sequence, Union
 from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import json
 import os
+import threading
 import requests
 from .validators import PaymentValidators
 from .enums import PaymentMethod
+from .deadline import Deadline, DeadlineExceeded
+from .profiling import PaymentProfiler
 from datetime import datetime
 import uuid
 from dotenv import load_dotenv  # Adiciona import do python-dotenv
@@ -12,6 +18,9 @@ import logging
 # Carrega as variáveis de ambiente
 load_dotenv()
 
+# Timeout padrão, em segundos, das requisições de captura e cancelamento
+CHARGE_ACTION_TIMEOUT = 30.0
+
 @dataclass
 class Phone:
     area: str
@@ -87,24 +96,86 @@ class PaymentConfig:
     capture: Optional[bool] = None
     soft_descriptor: Optional[str] = None
 
+class PagSeguroAPIError(Exception):
+    """Resposta de erro (status diferente de 2xx) da API do PagBank/PagSeguro"""
+
+    def __init__(self, message: str, status_code: int, response_text: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_text = response_text
+
+    @property
+    def retryable(self) -> bool:
+        """Erros do servidor e limite de requisições são transitórios; os demais 4xx não"""
+        return self.status_code >= 500 or self.status_code == 429
+
+@dataclass
+class ChargeOperationResult:
+    charge_id: str
+    amount: int
+    success: bool
+    response: Optional[Dict] = None
+    error: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
 class PagSeguroPayment:
-    def __init__(self):
-        self.base_url = os.getenv('PAGSEGURO_BASE_URL')
-        self.token = os.getenv('PAGSEGURO_TOKEN')
+    def __init__(self, token: Optional[str] = None, base_url: Optional[str] = None,
+                 session: Optional[requests.Session] = None,
+                 profiler: Optional[PaymentProfiler] = None):
+        """
+        Sem argumentos, lê token e URL de PAGSEGURO_TOKEN e PAGSEGURO_BASE_URL.
+
+        `session` permite compartilhar um mesmo pool de conexões entre vários clientes.
+        `profiler` amostra as chamadas de pagamento; por padrão vem de PAGSEGURO_PROFILE.
+        """
+        self.base_url = base_url or os.getenv('PAGSEGURO_BASE_URL')
+        self.token = token or os.getenv('PAGSEGURO_TOKEN')
         
         if not self.base_url:
             raise ValueError("PAGSEGURO_BASE_URL não configurado")
         if not self.token:
             raise ValueError("PAGSEGURO_TOKEN não configurado")
 
+        self.session = session or requests.Session()
+        self.profiler = profiler or PaymentProfiler.from_env()
+        # Profiler temporário de `profiling()`, válido só na thread que abriu o bloco
+        self._profiling = threading.local()
+
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
         
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
+        # O logger é global ao módulo; adiciona o handler apenas uma vez
+        if not self.logger.handlers:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(logging.DEBUG)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            console_handler.setFormatter(formatter)
+            self.logger.addHandler(console_handler)
+
+    def _profiled(self, name: str):
+        profiler = getattr(self._profiling, "profiler", None) or self.profiler
+        if profiler is None:
+            return nullcontext()
+        return profiler.profile(name)
+
+    @contextmanager
+    def profiling(self, sample_rate: float = 1.0, interval: float = 0.002,
+                  output_path: Optional[str] = None):
+        """
+        Perfila as chamadas de pagamento feitas, nesta thread, dentro do bloco.
+
+        Outras threads que usam o mesmo cliente não são afetadas. Retorna o
+        PaymentProfiler; com `output_path`, grava as pilhas ao sair do bloco.
+        """
+        previous = getattr(self._profiling, "profiler", None)
+        profiler = PaymentProfiler(sample_rate, interval, output_path)
+        self._profiling.profiler = profiler
+        try:
+            yield profiler
+        finally:
+            self._profiling.profiler = previous
+            if output_path:
+                profiler.dump()
 
     def _build_headers(self):
         return {
@@ -134,7 +205,7 @@ class PagSeguroPayment:
         if payment_method == PaymentMethod.CREDIT_CARD:
             payment_method_data.update({
                 "installments": payment_config.installments or 1,
-                "capture": payment_config.capture or True,
+                "capture": payment_config.capture if payment_config.capture is not None else True,
                 "soft_descriptor": payment_config.soft_descriptor
             })
         elif payment_method == PaymentMethod.DEBIT_CARD and card_data.authentication_method:
@@ -185,11 +256,25 @@ class PagSeguroPayment:
         else:
             raise ValueError(f"Método de pagamento '{method}' não suportado")
 
-    def process_payment(self, payment_data: dict):
+    def process_payment(self, payment_data: dict,
+                        deadline: Optional[Union[Deadline, datetime, float]] = None,
+                        timeout: Optional[float] = None):
         """
         Processa um pagamento usando o PagBank/PagSeguro
+
+        `deadline` (instante absoluto) e `timeout` (orçamento em segundos) limitam o
+        tempo total da operação; ao se esgotarem, levanta DeadlineExceeded.
         """
+        with self._profiled("process_payment"):
+            return self._process_payment(payment_data, deadline, timeout)
+
+    def _process_payment(self, payment_data: dict,
+                         deadline: Optional[Union[Deadline, datetime, float]],
+                         timeout: Optional[float]):
+        deadline = Deadline.resolve(deadline, timeout)
         try:
+            if deadline:
+                deadline.check("da normalização")
             # Usa a função de normalização
             payment_method = self._normalize_payment_method(payment_data.get('payment_method'))
             
@@ -249,16 +334,41 @@ class PagSeguroPayment:
                 items=items,
                 payment_method=payment_method,
                 payment_config=payment_config,
-                card_data=card_data
+                card_data=card_data,
+                deadline=deadline
             )
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             raise ValueError(f"Erro ao processar pagamento: {str(e)}")
 
     def create_payment(self, customer: Customer, address: Address, items: List[Item],
                       payment_method: PaymentMethod, payment_config: PaymentConfig,
-                      card_data: Optional[CardData] = None) -> Dict:
-        self.logger.info("Iniciando criação de pagamento no PagSeguro")
+                      card_data: Optional[CardData] = None,
+                      deadline: Optional[Union[Deadline, datetime, float]] = None,
+                      timeout: Optional[float] = None) -> Dict:
+        with self._profiled("create_payment"):
+            self.logger.info("Iniciando criação de pagamento no PagSeguro")
+            deadline = Deadline.resolve(deadline, timeout)
+            base_payment_data = self.build_payment_payload(
+                customer=customer,
+                address=address,
+                items=items,
+                payment_method=payment_method,
+                payment_config=payment_config,
+                card_data=card_data,
+                deadline=deadline
+            )
+            return self.send_order(base_payment_data, deadline=deadline)
+
+    def build_payment_payload(self, customer: Customer, address: Address, items: List[Item],
+                              payment_method: PaymentMethod, payment_config: PaymentConfig,
+                              card_data: Optional[CardData] = None,
+                              deadline: Optional[Deadline] = None) -> Dict:
+        """Valida os dados e monta o corpo do pedido enviado ao endpoint /orders"""
+        if deadline:
+            deadline.check("da validação")
         PaymentValidators.validate_customer_data(asdict(customer))
         PaymentValidators.validate_address(asdict(address))
         PaymentValidators.validate_payment_config(asdict(payment_config))
@@ -273,6 +383,9 @@ class PagSeguroPayment:
             pix_expiration = os.getenv('PIX_EXPIRATION_DATE')
             PaymentValidators.validate_pix_expiration(pix_expiration)
         
+        if deadline:
+            deadline.check("da serialização")
+
         base_payment_data = {
             "customer": asdict(customer),
             "shipping": {
@@ -310,13 +423,205 @@ class PagSeguroPayment:
                 payment_method, card_data, payment_config
             )
 
-        response = requests.post(
-            f"{self.base_url}/orders",
-            json=base_payment_data,
-            headers=self._build_headers()
+        return base_payment_data
+
+    def send_order(self, payment_data: Dict, idempotency_key: Optional[str] = None,
+                   deadline: Optional[Deadline] = None) -> Dict:
+        """
+        Envia um pedido já montado para o PagBank/PagSeguro.
+
+        Com `idempotency_key`, reenvios do mesmo pedido não geram pedidos duplicados.
+        Com `deadline`, o tempo restante vira o timeout da requisição HTTP.
+        """
+        headers = self._build_headers()
+        if idempotency_key:
+            headers["x-idempotency-key"] = idempotency_key
+
+        request_timeout = deadline.check("da requisição ao PagSeguro") if deadline else None
+        try:
+            response = self.session.post(
+                f"{self.base_url}/orders",
+                json=payment_data,
+                headers=headers,
+                timeout=request_timeout
+            )
+        except requests.Timeout as e:
+            if deadline:
+                raise DeadlineExceeded(f"Prazo esgotado aguardando resposta do PagSeguro: {e}")
+            raise
+
+        if response.status_code not in (200, 201):
+            raise PagSeguroAPIError(f"Erro ao criar pagamento: {response.text}",
+                                    response.status_code, response.text)
+
+        return response.json()
+
+    def capture_charge(self, charge_id: str, amount: int, idempotency_key: Optional[str] = None,
+                       timeout: float = CHARGE_ACTION_TIMEOUT) -> Dict:
+        """Captura, total ou parcialmente, uma cobrança pré-autorizada (valor em centavos)"""
+        return self._charge_action(charge_id, "capture", amount, idempotency_key, timeout)
+
+    def cancel_charge(self, charge_id: str, amount: int, idempotency_key: Optional[str] = None,
+                      timeout: float = CHARGE_ACTION_TIMEOUT) -> Dict:
+        """
+        Cancela, total ou parcialmente, uma cobrança (valor em centavos)
+
+        Sem `idempotency_key`, cada chamada é um novo cancelamento. Para repetir com
+        segurança uma chamada que falhou, informe a mesma chave.
+        """
+        return self._charge_action(charge_id, "cancel", amount, idempotency_key, timeout)
+
+    def capture_charges(self, charge_ids: Sequence[str], amounts: Sequence[int], max_workers: int = 8,
+                        progress_path: Optional[str] = None,
+                        timeout: float = CHARGE_ACTION_TIMEOUT) -> List[ChargeOperationResult]:
+        """
+        Captura várias cobranças pré-autorizadas em paralelo.
+
+        Com `progress_path`, cada resultado é registrado em um arquivo JSON Lines e
+        uma nova execução com o mesmo arquivo pula as cobranças já capturadas. Linhas
+        corrompidas (ex.: interrompidas por uma queda) e registros de outras operações
+        são ignorados. A retomada deve receber as mesmas listas, na mesma ordem: o
+        progresso é associado à posição de cada cobrança. `timeout` limita cada
+        requisição; cobranças que o excedem são reportadas como falha.
+        """
+        return self._bulk_charge_action("capture", charge_ids, amounts, max_workers, progress_path, timeout)
+
+    def cancel_charges(self, charge_ids: Sequence[str], amounts: Sequence[int], max_workers: int = 8,
+                       progress_path: Optional[str] = None,
+                       timeout: float = CHARGE_ACTION_TIMEOUT) -> List[ChargeOperationResult]:
+        """Cancela várias cobranças em paralelo, com o mesmo controle de progresso de `capture_charges`"""
+        return self._bulk_charge_action("cancel", charge_ids, amounts, max_workers, progress_path, timeout)
+
+    def _charge_action(self, charge_id: str, action: str, amount: int,
+                       idempotency_key: Optional[str] = None,
+                       timeout: float = CHARGE_ACTION_TIMEOUT) -> Dict:
+        if not charge_id:
+            raise ValueError("ID da cobrança é obrigatório")
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            raise ValueError("Valor deve ser um número inteiro positivo em centavos")
+
+        if not idempotency_key:
+            # Uma cobrança só é capturada uma vez, então a chave pode ser derivada dela. Já
+            # cancelamentos parciais de mesmo valor são legítimos e precisam de chaves distintas.
+            if action == "capture":
+                idempotency_key = f"capture-{charge_id}-{amount}"
+            else:
+                idempotency_key = str(uuid.uuid4())
+
+        headers = self._build_headers()
+        headers["x-idempotency-key"] = idempotency_key
+
+        self.logger.info(f"Executando {action} da cobrança {charge_id} no valor de {amount}")
+        response = self.session.post(
+            f"{self.base_url}/charges/{charge_id}/{action}",
+            json={"amount": {"value": amount}},
+            headers=headers,
+            timeout=timeout
         )
 
         if response.status_code not in (200, 201):
-            raise Exception(f"Erro ao criar pagamento: {response.text}")
+            raise PagSeguroAPIError(f"Erro ao executar {action} da cobrança {charge_id}: {response.text}",
+                                    response.status_code, response.text)
+
+        return response.json()
 
-        return response.json()
\ No newline at end of file
+    def _bulk_charge_action(self, action: str, charge_ids: Sequence[str], amounts: Sequence[int],
+                            max_workers: int, progress_path: Optional[str],
+                            timeout: float) -> List[ChargeOperationResult]:
+        if len(charge_ids) != len(amounts):
+            raise ValueError("charge_ids e amounts devem ter o mesmo tamanho")
+        if max_workers < 1:
+            raise ValueError("max_workers deve ser maior que zero")
+
+        done: Dict[tuple, ChargeOperationResult] = {}
+        keys: Dict[tuple, str] = {}
+        if progress_path and os.path.exists(progress_path):
+            done, keys = self._load_charge_progress(progress_path, action)
+
+        progress_lock = threading.Lock()
+        progress_file = None
+        if progress_path:
+            progress_file = open(progress_path, "a+", encoding="utf-8")
+            # Uma execução interrompida pode ter deixado a última linha incompleta
+            if progress_file.tell() > 0:
+                progress_file.seek(progress_file.tell() - 1)
+                if progress_file.read(1) != "\n":
+                    progress_file.write("\n")
+
+        def write_progress(record: Dict) -> None:
+            with progress_lock:
+                progress_file.write(json.dumps(record) + "\n")
+                progress_file.flush()
+
+        def run(index: int, charge_id: str, amount: int) -> ChargeOperationResult:
+            position = (index, charge_id, amount)
+            if position in done:
+                return done[position]
+
+            # Retomadas reaproveitam a chave já usada nesta posição, então não repetem a operação
+            key = keys.get(position)
+            if key is None:
+                key = f"capture-{charge_id}-{amount}" if action == "capture" else str(uuid.uuid4())
+            if progress_file:
+                write_progress({"action": action, "index": index, "started": True,
+                                "charge_id": charge_id, "amount": amount, "idempotency_key": key})
+
+            try:
+                response = self._charge_action(charge_id, action, amount, key, timeout=timeout)
+                result = ChargeOperationResult(charge_id, amount, True, response=response,
+                                               idempotency_key=key)
+            except Exception as e:
+                result = ChargeOperationResult(charge_id, amount, False, error=str(e), idempotency_key=key)
+
+            if progress_file:
+                write_progress({"action": action, "index": index, **asdict(result)})
+            return result
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(run, range(len(charge_ids)), charge_ids, amounts))
+        finally:
+            if progress_file:
+                progress_file.close()
+
+        failed = sum(1 for r in results if not r.success)
+        self.logger.info(f"{action} em lote finalizado: {len(results) - failed} sucesso(s), {failed} falha(s)")
+        return results
+
+    def _load_charge_progress(self, progress_path: str, action: str):
+        """
+        Retorna, por posição (índice, cobrança, valor), os resultados já concluídos e
+        as chaves de idempotência já usadas
+        """
+        done: Dict[tuple, ChargeOperationResult] = {}
+        keys: Dict[tuple, str] = {}
+        other_actions = 0
+        with open(progress_path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    record_action = record.pop("action", None)
+                    index = record.pop("index", None)
+                    started = record.pop("started", False)
+                    position = (index, record["charge_id"], record["amount"])
+                    result = None if started else ChargeOperationResult(**record)
+                except (ValueError, TypeError, KeyError) as e:
+                    self.logger.warning(f"Ignorando linha {line_number} inválida em {progress_path}: {e}")
+                    continue
+
+                if record_action != action:
+                    other_actions += 1
+                    continue
+                if record.get("idempotency_key"):
+                    keys[position] = record["idempotency_key"]
+                if result and result.success:
+                    done[position] = result
+
+        if other_actions:
+            self.logger.warning(
+                f"Ignorando {other_actions} registro(s) de outras operações em {progress_path}"
+            )
+        self.logger.info(f"Retomando {action} em lote: {len(done)} cobrança(s) já concluída(s)")
+        return done, keys
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from decimal import Decimal
+from fractions import Fraction
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from .validators import PaymentValidators
+
+@dataclass(frozen=True)
+class InstallmentPlan:
+    """
+    Plano de parcelamento de uma bandeira para o lojista.
+
+    `monthly_interest_rate` é a taxa mensal (ex.: "0.0199" para 1,99% a.m.) aplicada,
+    pela Tabela Price, às opções acima de `interest_free_installments`. Opções com
+    parcela abaixo de `min_installment_value` (em centavos) não são oferecidas.
+    """
+    monthly_interest_rate: Union[str, Decimal] = "0"
+    interest_free_installments: int = 1
+    max_installments: int = 12
+    min_installment_value: int = 0
+
+@dataclass(frozen=True)
+class InstallmentOption:
+    installments: int
+    installment_value: int
+    first_installment_value: int
+    total_value: int
+    interest_free: bool
+
+# (parcelas, numerador, denominador, sem_juros): valor da parcela = valor * numerador / denominador
+_Coefficient = Tuple[int, int, int, bool]
+
+class InstallmentSimulator:
+    """
+    Simula as opções de parcelamento de um valor, em centavos.
+
+    Os coeficientes de cada bandeira/plano são calculados uma única vez, como frações
+    exatas, e cada cotação é feita só com aritmética inteira e arredondamento meio
+    para cima. As cotações ficam em cache, então recalcular o mesmo carrinho é imediato.
+    """
+
+    def __init__(self, plans: Optional[Dict[str, InstallmentPlan]] = None, cache_size: int = 4096):
+        # Tabela e plano ficam juntos para que uma cotação nunca misture planos diferentes
+        self._tables: Dict[Tuple[str, str], Tuple[List[_Coefficient], InstallmentPlan]] = {}
+        self._cache: "OrderedDict[Tuple[int, str, str], Tuple[InstallmentOption, ...]]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        # Incrementada a cada troca de plano; cotações calculadas antes dela não entram no cache
+        self._generation = 0
+
+        for brand, plan in (plans or {}).items():
+            self.register_plan(brand, plan)
+
+    def register_plan(self, brand: str, plan: InstallmentPlan, merchant_plan: str = "default") -> None:
+        """Registra (ou substitui) o plano de uma bandeira e pré-calcula sua tabela"""
+        PaymentValidators.validate_installments(plan.max_installments)
+        if not (1 <= plan.interest_free_installments <= plan.max_installments):
+            raise ValueError("Parcelas sem juros devem estar entre 1 e o máximo de parcelas")
+
+        rate = Fraction(Decimal(str(plan.monthly_interest_rate)))
+        if rate < 0:
+            raise ValueError("Taxa de juros não pode ser negativa")
+
+        table = []
+        for n in range(1, plan.max_installments + 1):
+            if n <= plan.interest_free_installments or rate == 0:
+                coefficient = Fraction(1, n)
+                interest_free = True
+            else:
+                # Tabela Price: i * (1 + i)^n / ((1 + i)^n - 1)
+                growth = (1 + rate) ** n
+                coefficient = rate * growth / (growth - 1)
+                interest_free = False
+            table.append((n, coefficient.numerator, coefficient.denominator, interest_free))
+
+        key = (brand.lower(), merchant_plan)
+        with self._cache_lock:
+            self._tables[key] = (table, plan)
+            self._generation += 1
+            self._cache.clear()
+
+    def quote(self, amount: int, brand: str, merchant_plan: str = "default") -> Tuple[InstallmentOption, ...]:
+        """Retorna todas as opções de parcelamento para o valor (em centavos)"""
+        return self.quote_many([amount], brand, merchant_plan)[0]
+
+    def quote_many(self, amounts: Sequence[int], brand: str,
+                   merchant_plan: str = "default") -> List[Tuple[InstallmentOption, ...]]:
+        """Retorna as opções de parcelamento de vários valores de uma vez, na mesma ordem"""
+        for amount in amounts:
+            self._validate_amount(amount)
+        brand = brand.lower()
+
+        results: Dict[int, Tuple[InstallmentOption, ...]] = {}
+        with self._cache_lock:
+            for amount in amounts:
+                options = self._cache.get((amount, brand, merchant_plan))
+                if options is not None:
+                    self._cache.move_to_end((amount, brand, merchant_plan))
+                    results[amount] = options
+            generation = self._generation
+            entry = self._tables.get((brand, merchant_plan))
+
+        missing = [amount for amount in dict.fromkeys(amounts) if amount not in results]
+        if missing:
+            if entry is None:
+                raise ValueError(f"Plano de parcelamento não configurado para a bandeira '{brand}'")
+            table, plan = entry
+            computed = self._compute(missing, table, plan.min_installment_value)
+            results.update(zip(missing, computed))
+
+            with self._cache_lock:
+                # Se o plano mudou durante o cálculo, devolve o resultado mas não o guarda
+                if generation == self._generation:
+                    for amount, options in zip(missing, computed):
+                        self._cache[(amount, brand, merchant_plan)] = options
+                    while len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+
+        return [results[amount] for amount in amounts]
+
+    @staticmethod
+    def _validate_amount(amount: int) -> None:
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            raise ValueError("Valor deve ser um número inteiro positivo em centavos")
+
+    @staticmethod
+    def _compute(amounts: Sequence[int], table: List[_Coefficient],
+                 min_value: int) -> List[Tuple[InstallmentOption, ...]]:
+        rows: List[List[InstallmentOption]] = [[] for _ in amounts]
+        # Percorre a tabela uma vez, calculando cada opção para todos os valores
+        for n, num, den, interest_free in table:
+            if interest_free:
+                for row, amount in zip(rows, amounts):
+                    value, remainder = divmod(amount, n)
+                    if n == 1 or value >= min_value:
+                        row.append(InstallmentOption(n, value, value + remainder, amount, True))
+            else:
+                for row, amount in zip(rows, amounts):
+                    value = (2 * amount * num + den) // (2 * den)
+                    if n == 1 or value >= min_value:
+                        row.append(InstallmentOption(n, value, value, value * n, False))
+
+        return [tuple(row) for row in rows]
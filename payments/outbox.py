@@ -0,0 +1,438 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from .deadline import Deadline, DeadlineExceeded
+from .gateway import PagSeguroAPIError
+
+STATUS_PENDING = "PENDING"
+STATUS_IN_FLIGHT = "IN_FLIGHT"
+STATUS_SENT = "SENT"
+STATUS_FAILED = "FAILED"
+# Já enviado ao menos uma vez, sem resposta conhecida e sem como reenviar: o pedido
+# pode ou não existir no PagBank e precisa ser conciliado (veja `reconcile`)
+STATUS_UNKNOWN = "UNKNOWN"
+
+_CARD_LOST_ERROR = "Dados do cartão indisponíveis após reinício"
+
+# Campos do cartão que nunca são gravados em disco
+_SENSITIVE_CARD_FIELDS = ("number", "security_code")
+
+
+class _OutboxEntry:
+    def __init__(self, key: str, payload: str, card_secrets: Dict[int, Dict]):
+        self.key = key
+        self.payload = payload
+        self.card_secrets = card_secrets
+        self.inserted = False
+        self.committed = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class PaymentOutbox:
+    """
+    Outbox local (SQLite em modo WAL) para envio de pedidos ao PagBank/PagSeguro.
+
+    Os pedidos são gravados em disco antes do envio, em commits agrupados, e um
+    despachante em segundo plano os envia com concorrência limitada, registrando
+    a resposta de cada um. Pedidos não finalizados são reenviados ao reiniciar,
+    sempre com a mesma chave de idempotência, então um reenvio não duplica o pedido.
+
+    Cada envio tem no máximo `request_timeout` segundos. Falhas de rede, prazo
+    esgotado, 5xx e 429 são tentadas de novo até `max_attempts`; os demais erros
+    (como 4xx de validação) marcam o pedido como FAILED imediatamente.
+
+    Número e código de segurança do cartão nunca são gravados em disco: ficam só em
+    memória até o envio. Por isso, pedidos com cartão aberto não podem ser reenviados
+    após um reinício: os que nunca foram enviados viram FAILED, e os que já foram
+    enviados ao menos uma vez viram UNKNOWN, pois podem ter sido criados no PagBank.
+    Pedidos UNKNOWN são listados por `in_doubt` e finalizados com `reconcile`. Para
+    reenvio automático após falha, use cartão criptografado (`card.encrypted`) ou
+    tokenizado (`card.id`).
+
+    Retenção: ao chegar em SENT ou FAILED, o corpo do pedido é apagado da tabela;
+    permanecem apenas chave, status, tentativas, resposta e erro. Pedidos UNKNOWN
+    mantêm o corpo, já sem os dados sensíveis, até serem conciliados.
+    """
+
+    def __init__(self, gateway, path: str = "pagseguro_outbox.db", max_workers: int = 8,
+                 batch_size: int = 500, max_attempts: int = 5, retry_interval: float = 1.0,
+                 poll_interval: float = 0.5, request_timeout: float = 30.0):
+        if max_workers < 1:
+            raise ValueError("max_workers deve ser maior que zero")
+        if batch_size < 1:
+            raise ValueError("batch_size deve ser maior que zero")
+        if request_timeout <= 0:
+            raise ValueError("request_timeout deve ser maior que zero")
+
+        self.gateway = gateway
+        self.logger = gateway.logger
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval
+        self.request_timeout = request_timeout
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        # Sobrescreve com zeros o conteúdo apagado, em vez de só liberar as páginas
+        self._conn.execute("PRAGMA secure_delete=ON")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                payload TEXT,
+                card_redacted INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                response TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, available_at)")
+        self._db_lock = threading.Lock()
+
+        self._queue: List[_OutboxEntry] = []
+        self._queue_cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._in_flight = 0
+        self._in_flight_cond = threading.Condition()
+
+        # Dados sensíveis do cartão, por chave, mantidos apenas em memória até o envio
+        self._card_secrets: Dict[str, Dict[int, Dict]] = {}
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._writer: Optional[threading.Thread] = None
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Inicia o gravador e o despachante, reenviando pedidos não finalizados"""
+        if self._dispatcher is not None:
+            return
+
+        now = time.time()
+        with self._db_lock:
+            # Sem os dados do cartão em memória, um envio interrompido não pode ser repetido
+            in_doubt = self._conn.execute(
+                "UPDATE outbox SET status = ?, error = ?, updated_at = ? "
+                "WHERE status = ? AND card_redacted = 1",
+                (STATUS_UNKNOWN, _CARD_LOST_ERROR, now, STATUS_IN_FLIGHT)
+            ).rowcount
+            replayed = self._conn.execute(
+                "UPDATE outbox SET status = ?, updated_at = ? WHERE status = ?",
+                (STATUS_PENDING, now, STATUS_IN_FLIGHT)
+            ).rowcount
+        if replayed:
+            self.logger.info(f"Outbox: {replayed} pedido(s) sem resposta serão reenviados")
+        if in_doubt:
+            self.logger.error(f"Outbox: {in_doubt} pedido(s) com cartão aberto precisam de conciliação")
+
+        self._stopping.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="pagseguro-outbox")
+        self._writer = threading.Thread(target=self._write_loop, name="pagseguro-outbox-writer",
+                                        daemon=True)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop,
+                                            name="pagseguro-outbox-dispatcher", daemon=True)
+        self._writer.start()
+        self._dispatcher.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Grava os pedidos ainda em memória e interrompe o despacho.
+
+        Pedidos pendentes permanecem na outbox e são enviados no próximo `start`.
+        """
+        if self._dispatcher is None:
+            return
+
+        self._stopping.set()
+        with self._queue_cond:
+            self._queue_cond.notify_all()
+        with self._in_flight_cond:
+            self._in_flight_cond.notify_all()
+        self._wakeup.set()
+
+        self._writer.join()
+        self._dispatcher.join()
+        self._executor.shutdown(wait=wait)
+        self._writer = self._dispatcher = self._executor = None
+
+    def close(self):
+        self.stop()
+        self._conn.close()
+
+    def enqueue(self, payment_data: Dict, idempotency_key: Optional[str] = None) -> str:
+        """
+        Grava um pedido já montado na outbox e retorna sua chave de idempotência.
+
+        Retorna somente depois que o pedido estiver persistido em disco. Se a chave
+        já existir na outbox, o pedido é descartado e a chave é retornada, como em
+        qualquer requisição idempotente repetida.
+        """
+        if self._writer is None:
+            raise RuntimeError("Outbox não iniciada")
+
+        key = idempotency_key or str(uuid.uuid4())
+        payload, secrets = self._redact_card(payment_data)
+        entry = _OutboxEntry(key, json.dumps(payload), secrets)
+        with self._queue_cond:
+            if self._stopping.is_set():
+                raise RuntimeError("Outbox em processo de parada")
+            self._queue.append(entry)
+            self._queue_cond.notify()
+
+        entry.committed.wait()
+        if entry.error:
+            raise entry.error
+        if not entry.inserted:
+            self.logger.warning(f"Outbox: chave {key} já existente; pedido duplicado descartado")
+        return entry.key
+
+    def submit(self, idempotency_key: Optional[str] = None, **payment_kwargs) -> str:
+        """Valida e monta o pedido como `create_payment`, mas o grava na outbox em vez de enviá-lo"""
+        payment_data = self.gateway.build_payment_payload(**payment_kwargs)
+        return self.enqueue(payment_data, idempotency_key=idempotency_key)
+
+    def get(self, idempotency_key: str) -> Optional[Dict]:
+        """Retorna o estado de um pedido da outbox, com a resposta do PagBank quando houver"""
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT id, status, attempts, response, error FROM outbox WHERE id = ?",
+                (idempotency_key,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        return {
+            "id": row[0],
+            "status": row[1],
+            "attempts": row[2],
+            "response": json.loads(row[3]) if row[3] else None,
+            "error": row[4]
+        }
+
+    def in_doubt(self) -> List[Dict]:
+        """
+        Lista os pedidos UNKNOWN, que podem existir no PagBank sem resposta registrada.
+
+        Cada item traz a chave de idempotência e o `reference_id` do pedido, para
+        consulta no PagBank antes de chamar `reconcile`.
+        """
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT id, payload, attempts, error FROM outbox WHERE status = ? ORDER BY created_at",
+                (STATUS_UNKNOWN,)
+            ).fetchall()
+
+        return [{
+            "id": key,
+            "reference_id": json.loads(payload).get("reference_id") if payload else None,
+            "attempts": attempts,
+            "error": error
+        } for key, payload, attempts, error in rows]
+
+    def reconcile(self, idempotency_key: str, response: Optional[Dict] = None) -> None:
+        """
+        Finaliza um pedido UNKNOWN: com `response` (o pedido encontrado no PagBank)
+        vira SENT; sem ela, confirma que o pedido não existe e vira FAILED.
+        """
+        with self._db_lock:
+            row = self._conn.execute("SELECT status FROM outbox WHERE id = ?",
+                                     (idempotency_key,)).fetchone()
+        if row is None:
+            raise KeyError(f"Pedido {idempotency_key} não encontrado na outbox")
+        if row[0] != STATUS_UNKNOWN:
+            raise ValueError(f"Pedido {idempotency_key} não está aguardando conciliação")
+
+        if response is not None:
+            self._record(idempotency_key, STATUS_SENT, response=json.dumps(response))
+        else:
+            self._record(idempotency_key, STATUS_FAILED, error="Pedido não encontrado na conciliação")
+
+    @staticmethod
+    def _redact_card(payment_data: Dict):
+        """Retorna uma cópia do pedido sem os dados sensíveis do cartão e esses dados, por cobrança"""
+        payload = json.loads(json.dumps(payment_data))
+        secrets: Dict[int, Dict] = {}
+        for index, charge in enumerate(payload.get("charges") or []):
+            card = (charge.get("payment_method") or {}).get("card")
+            if not card:
+                continue
+            removed = {field: card.pop(field) for field in _SENSITIVE_CARD_FIELDS if field in card}
+            if removed:
+                secrets[index] = removed
+        return payload, secrets
+
+    def _write_loop(self):
+        while True:
+            with self._queue_cond:
+                while not self._queue and not self._stopping.is_set():
+                    self._queue_cond.wait()
+                if not self._queue:
+                    return
+                # Tudo que chegou durante o commit anterior entra no mesmo commit
+                batch = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+
+            now = time.time()
+            try:
+                with self._db_lock:
+                    self._conn.execute("BEGIN")
+                    try:
+                        for entry in batch:
+                            entry.inserted = self._conn.execute(
+                                "INSERT OR IGNORE INTO outbox "
+                                "(id, payload, card_redacted, status, available_at, created_at, updated_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (entry.key, entry.payload, int(bool(entry.card_secrets)),
+                                 STATUS_PENDING, now, now, now)
+                            ).rowcount == 1
+                            # Só pedidos realmente gravados guardam os dados do cartão; ainda sob
+                            # o lock, então o despachante nunca vê a linha sem eles
+                            if entry.inserted and entry.card_secrets:
+                                self._card_secrets[entry.key] = entry.card_secrets
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        for entry in batch:
+                            if entry.inserted:
+                                self._card_secrets.pop(entry.key, None)
+                                entry.inserted = False
+                        raise
+            except Exception as e:
+                self.logger.error(f"Outbox: falha ao gravar {len(batch)} pedido(s): {e}")
+                for entry in batch:
+                    entry.error = e
+
+            for entry in batch:
+                entry.card_secrets = {}
+                entry.committed.set()
+            self._wakeup.set()
+
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            with self._in_flight_cond:
+                while self._in_flight >= self.max_workers and not self._stopping.is_set():
+                    self._in_flight_cond.wait()
+                capacity = self.max_workers - self._in_flight
+
+            claimed = self._claim(capacity) if capacity > 0 else []
+            for key, payload, attempts in claimed:
+                with self._in_flight_cond:
+                    self._in_flight += 1
+                self._executor.submit(self._deliver, key, payload, attempts)
+
+            if not claimed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _claim(self, limit: int) -> List[tuple]:
+        now = time.time()
+        claimed, never_sent, in_doubt = [], [], []
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, payload, card_redacted, attempts FROM outbox "
+                    "WHERE status = ? AND available_at <= ? ORDER BY created_at LIMIT ?",
+                    (STATUS_PENDING, now, limit)
+                ).fetchall()
+                for key, payload, card_redacted, attempts in rows:
+                    if card_redacted and key not in self._card_secrets:
+                        (in_doubt if attempts else never_sent).append(key)
+                    else:
+                        claimed.append((key, payload, attempts + 1))
+
+                self._conn.executemany(
+                    "UPDATE outbox SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    [(STATUS_IN_FLIGHT, now, key) for key, _, _ in claimed]
+                )
+                # Os dados do cartão se perderam num reinício e o pedido não pode ser reenviado.
+                # Se nunca foi enviado, falhou; se já foi, pode existir no PagBank.
+                self._conn.executemany(
+                    "UPDATE outbox SET status = ?, payload = NULL, error = ?, updated_at = ? WHERE id = ?",
+                    [(STATUS_FAILED, _CARD_LOST_ERROR, now, key) for key in never_sent]
+                )
+                self._conn.executemany(
+                    "UPDATE outbox SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                    [(STATUS_UNKNOWN, _CARD_LOST_ERROR, now, key) for key in in_doubt]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if never_sent:
+            self.logger.error(f"Outbox: {len(never_sent)} pedido(s) com cartão aberto não podem ser enviados")
+        if in_doubt:
+            self.logger.error(f"Outbox: {len(in_doubt)} pedido(s) com cartão aberto precisam de conciliação")
+        return [(key, self._restore_card(key, json.loads(payload)), attempts)
+                for key, payload, attempts in claimed]
+
+    def _restore_card(self, key: str, payment_data: Dict) -> Dict:
+        for index, removed in self._card_secrets.get(key, {}).items():
+            payment_data["charges"][index]["payment_method"]["card"].update(removed)
+        return payment_data
+
+    def _deliver(self, key: str, payment_data: Dict, attempts: int):
+        try:
+            response = self.gateway.send_order(payment_data, idempotency_key=key,
+                                               deadline=Deadline.after(self.request_timeout))
+            self._record(key, STATUS_SENT, response=json.dumps(response))
+        except Exception as e:
+            if not self._is_retryable(e):
+                self.logger.error(f"Outbox: pedido {key} recusado: {e}")
+                self._record(key, STATUS_FAILED, error=str(e))
+            elif attempts >= self.max_attempts:
+                self.logger.error(f"Outbox: pedido {key} falhou após {attempts} tentativa(s): {e}")
+                self._record(key, STATUS_FAILED, error=str(e))
+            else:
+                self.logger.warning(f"Outbox: tentativa {attempts} do pedido {key} falhou: {e}")
+                self._record(key, STATUS_PENDING, error=str(e),
+                             available_at=time.time() + self.retry_interval * attempts)
+        finally:
+            with self._in_flight_cond:
+                self._in_flight -= 1
+                self._in_flight_cond.notify()
+            self._wakeup.set()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, PagSeguroAPIError):
+            return error.retryable
+        return isinstance(error, (requests.RequestException, DeadlineExceeded))
+
+    def _record(self, key: str, status: str, response: Optional[str] = None,
+                error: Optional[str] = None, available_at: Optional[float] = None):
+        now = time.time()
+        final = status in (STATUS_SENT, STATUS_FAILED)
+        with self._db_lock:
+            # Em estado final o corpo do pedido não é mais necessário e é apagado
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, response = ?, error = ?, available_at = ?, "
+                "updated_at = ?, payload = CASE WHEN ? THEN NULL ELSE payload END WHERE id = ?",
+                (status, response, error, available_at or now, now, int(final), key)
+            )
+        if final:
+            self._card_secrets.pop(key, None)
@@ -0,0 +1,159 @@
+import atexit
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+
+_env_profiler = None
+_env_lock = threading.Lock()
+
+
+class PaymentProfiler:
+    """
+    Profiler por amostragem para as chamadas de pagamento.
+
+    Apenas uma fração (`sample_rate`) das chamadas é perfilada. Durante uma chamada
+    amostrada, uma thread auxiliar captura a pilha da thread chamadora a cada
+    `interval` segundos. As pilhas são agregadas no formato "collapsed" (uma pilha
+    por linha, quadros separados por ";", seguida da contagem), lido por
+    flamegraph.pl, speedscope e similares.
+
+    `{pid}` em `output_path` é trocado pelo PID do processo no momento da gravação,
+    para que cada worker de um servidor pre-fork grave o próprio arquivo. Com
+    `flush_interval`, o arquivo é regravado periodicamente, então as amostras não
+    se perdem se o processo for encerrado sem passar pelo `atexit`.
+    """
+
+    def __init__(self, sample_rate: float = 0.01, interval: float = 0.002,
+                 output_path: Optional[str] = None, flush_interval: Optional[float] = None):
+        if not (0 <= sample_rate <= 1):
+            raise ValueError("sample_rate deve estar entre 0 e 1")
+        if interval <= 0:
+            raise ValueError("interval deve ser maior que zero")
+
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.output_path = output_path
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self.stacks: Counter = Counter()
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    @classmethod
+    def from_env(cls) -> Optional["PaymentProfiler"]:
+        """
+        Retorna o profiler configurado por PAGSEGURO_PROFILE (liga/desliga), PAGSEGURO_PROFILE_RATE,
+        PAGSEGURO_PROFILE_INTERVAL, PAGSEGURO_PROFILE_OUTPUT e PAGSEGURO_PROFILE_FLUSH_INTERVAL,
+        ou None se desligado.
+
+        A instância é única por processo e grava o arquivo de saída a cada
+        PAGSEGURO_PROFILE_FLUSH_INTERVAL segundos (padrão 60) e ao encerrar. O PID
+        é sempre incluído no nome do arquivo.
+        """
+        global _env_profiler
+        if os.getenv('PAGSEGURO_PROFILE', '').lower() not in ('1', 'true'):
+            return None
+
+        with _env_lock:
+            if _env_profiler is not None:
+                return _env_profiler
+
+            profiler = cls(
+                sample_rate=float(os.getenv('PAGSEGURO_PROFILE_RATE') or '0.01'),
+                interval=float(os.getenv('PAGSEGURO_PROFILE_INTERVAL') or '0.002'),
+                output_path=_with_pid(os.getenv('PAGSEGURO_PROFILE_OUTPUT') or 'pagseguro.collapsed'),
+                flush_interval=float(os.getenv('PAGSEGURO_PROFILE_FLUSH_INTERVAL') or '60')
+            )
+            atexit.register(profiler.dump)
+            _env_profiler = profiler
+            return profiler
+
+    @contextmanager
+    def profile(self, name: str):
+        """Perfila o bloco, se ele for sorteado e não estiver dentro de outro bloco perfilado"""
+        if getattr(self._active, "value", False) or random.random() >= self.sample_rate:
+            yield
+            return
+
+        self._active.value = True
+        # Quadro que abriu o bloco: as pilhas param nele, para somar o tempo por etapa
+        # da chamada independentemente de onde ela foi feita
+        entry = sys._getframe(1)
+        while entry is not None and entry.f_code.co_filename == contextlib.__file__:
+            entry = entry.f_back
+        target = threading.get_ident()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(name, target, entry, stop),
+                                   name="pagseguro-profiler", daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            self._active.value = False
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if not (self.flush_interval and self.output_path):
+            return
+        with self._lock:
+            if time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = time.monotonic()
+        self.dump()
+
+    def _sample(self, name: str, target: int, entry, stop: threading.Event):
+        samples: Counter = Counter()
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None and frame is not entry:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(name)
+            samples[";".join(reversed(stack))] += 1
+
+        with self._lock:
+            self.stacks.update(samples)
+
+    def dump(self, path: Optional[str] = None) -> str:
+        """
+        Grava as pilhas agregadas no formato collapsed e retorna o caminho do arquivo.
+
+        Sem amostras, o arquivo é criado vazio.
+        """
+        path = path or self.output_path
+        if not path:
+            raise ValueError("Caminho de saída do profiler não configurado")
+        path = path.replace("{pid}", str(os.getpid()))
+
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())]
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        return path
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stacks.clear()
+
+
+def _with_pid(path: str) -> str:
+    """Garante o marcador {pid} no nome do arquivo, antes da extensão"""
+    if "{pid}" in path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{{pid}}{ext}"
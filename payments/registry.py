@@ -0,0 +1,78 @@
+import os
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .gateway import PagSeguroPayment
+
+
+class PagSeguroClientRegistry:
+    """
+    Mantém um cliente PagSeguroPayment por lojista, todos compartilhando a mesma
+    sessão HTTP (e portanto o mesmo pool de conexões) e a mesma URL base.
+
+    Os tokens podem ser trocados a qualquer momento com `rotate_token`, sem
+    recriar o cliente nem o pool de conexões.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, pool_maxsize: int = 50,
+                 session: Optional[requests.Session] = None):
+        self.base_url = base_url or os.getenv('PAGSEGURO_BASE_URL')
+        if not self.base_url:
+            raise ValueError("PAGSEGURO_BASE_URL não configurado")
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+
+        self._clients: Dict[str, PagSeguroPayment] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get(self, merchant_id: str, token: Optional[str] = None) -> PagSeguroPayment:
+        """
+        Retorna o cliente do lojista, criando-o na primeira chamada.
+
+        `token` só é usado na criação; para trocar o token de um lojista já
+        registrado, use `rotate_token`.
+        """
+        client = self._clients.get(merchant_id)
+        if client is None:
+            if not token:
+                raise ValueError(f"Token não configurado para o lojista {merchant_id}")
+            with self._lock:
+                client = self._clients.get(merchant_id)
+                if client is None:
+                    client = PagSeguroPayment(token=token, base_url=self.base_url, session=self.session)
+                    self._clients[merchant_id] = client
+        return client
+
+    def rotate_token(self, merchant_id: str, token: str) -> PagSeguroPayment:
+        """Troca o token de um lojista já registrado; as próximas requisições já usam o novo token"""
+        if not token:
+            raise ValueError("Token não pode ser vazio")
+        client = self._clients.get(merchant_id)
+        if client is None:
+            raise KeyError(f"Lojista {merchant_id} não registrado")
+        client.token = token
+        return client
+
+    def remove(self, merchant_id: str) -> None:
+        with self._lock:
+            self._clients.pop(merchant_id, None)
+
+    def close(self) -> None:
+        """Remove todos os clientes e fecha as conexões do pool compartilhado"""
+        with self._lock:
+            self._clients.clear()
+        self.session.close()
@@ -0,0 +1,90 @@
+import json
+import logging
+
+import requests
+
+from payments import PagSeguroPayment
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+class StubSession:
+    def __init__(self, fail_calls=()):
+        self.fail_calls = set(fail_calls)
+        self.calls = []
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        self.calls.append({"url": url, "key": headers["x-idempotency-key"], "timeout": timeout})
+        if len(self.calls) in self.fail_calls:
+            raise requests.ConnectionError("connection reset")
+        return StubResponse(201, {"id": url.split("/")[-2]})
+
+
+def make_gateway(session):
+    gateway = PagSeguroPayment(token="token", base_url="http://pagseguro.test", session=session)
+    gateway.logger.setLevel(logging.CRITICAL)
+    return gateway
+
+
+def test_partial_cancels_of_same_amount_use_distinct_keys():
+    session = StubSession()
+    gateway = make_gateway(session)
+
+    gateway.cancel_charge("CHAR_1", 500)
+    gateway.cancel_charge("CHAR_1", 500)
+    gateway.capture_charge("CHAR_2", 1000)
+    gateway.capture_charge("CHAR_2", 1000)
+
+    cancel_keys = [call["key"] for call in session.calls[:2]]
+    capture_keys = [call["key"] for call in session.calls[2:]]
+    assert cancel_keys[0] != cancel_keys[1]
+    assert capture_keys[0] == capture_keys[1]
+
+
+def test_bulk_cancel_resume_reuses_keys_and_skips_done(tmp_path):
+    progress = str(tmp_path / "progress.jsonl")
+    failing = StubSession(fail_calls={1})
+    results = make_gateway(failing).cancel_charges(["CHAR_1", "CHAR_1", "CHAR_2"], [500, 500, 700],
+                                                  max_workers=1, progress_path=progress)
+    assert [result.success for result in results] == [False, True, True]
+
+    session = StubSession()
+    results = make_gateway(session).cancel_charges(["CHAR_1", "CHAR_1", "CHAR_2"], [500, 500, 700],
+                                                   progress_path=progress)
+
+    assert all(result.success for result in results)
+    # Só a primeira posição, que falhou, é repetida, e com a mesma chave da primeira execução
+    assert [call["key"] for call in session.calls] == [failing.calls[0]["key"]]
+
+
+def test_resume_after_crash_mid_request_reuses_started_key(tmp_path):
+    progress = tmp_path / "progress.jsonl"
+    progress.write_text(
+        json.dumps({"action": "cancel", "index": 0, "started": True, "charge_id": "CHAR_1",
+                    "amount": 500, "idempotency_key": "cancel-key-1"}) + "\n"
+        + '{"action": "cancel", "index": 0, "charge_id": "CHA'
+    )
+
+    session = StubSession()
+    results = make_gateway(session).cancel_charges(["CHAR_1"], [500], progress_path=str(progress))
+
+    assert results[0].success
+    assert [call["key"] for call in session.calls] == ["cancel-key-1"]
+
+
+def test_progress_from_capture_does_not_skip_cancel(tmp_path):
+    progress = str(tmp_path / "progress.jsonl")
+    make_gateway(StubSession()).capture_charges(["CHAR_1"], [500], progress_path=progress)
+
+    session = StubSession()
+    make_gateway(session).cancel_charges(["CHAR_1"], [500], progress_path=progress)
+
+    assert [call["url"] for call in session.calls] == ["http://pagseguro.test/charges/CHAR_1/cancel"]
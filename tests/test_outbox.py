@@ -0,0 +1,231 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import pytest
+import requests
+
+from payments import PagSeguroPayment, PaymentOutbox
+
+CARD_NUMBER = "4111111111111111"
+SECURITY_CODE = "123"
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+class StubSession:
+    """Sessão HTTP falsa: `handler(chamada)` retorna uma StubResponse ou levanta uma exceção"""
+
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda call: StubResponse(201, {"id": "ORDE_1"}))
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        with self._lock:
+            call = {"url": url, "json": json, "headers": headers, "timeout": timeout,
+                    "number": len(self.calls) + 1}
+            self.calls.append(call)
+        return self.handler(call)
+
+
+def card_order(reference_id="ref-1"):
+    return {
+        "reference_id": reference_id,
+        "charges": [{
+            "payment_method": {
+                "type": "CREDIT_CARD",
+                "card": {"number": CARD_NUMBER, "security_code": SECURITY_CODE, "exp_month": 12,
+                         "exp_year": 2030}
+            }
+        }]
+    }
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condição não atingida a tempo")
+
+
+@pytest.fixture
+def make_outbox(tmp_path):
+    outboxes = []
+
+    def make(session, **kwargs):
+        gateway = PagSeguroPayment(token="token", base_url="http://pagseguro.test", session=session)
+        gateway.logger.setLevel(logging.CRITICAL)
+        options = {"poll_interval": 0.01, "retry_interval": 0.01}
+        options.update(kwargs)
+        outbox = PaymentOutbox(gateway, path=str(tmp_path / "outbox.db"), **options)
+        outboxes.append(outbox)
+        return outbox
+
+    yield make
+    for outbox in outboxes:
+        outbox.close()
+
+
+def insert_row(path, key, status, attempts, card_redacted, payload=None):
+    now = time.time()
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO outbox (id, payload, card_redacted, status, attempts, available_at, "
+        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (key, json.dumps(payload or {"reference_id": f"ref-{key}"}), int(card_redacted), status,
+         attempts, now, now, now)
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_group_commit_and_delivery(make_outbox):
+    session = StubSession()
+    outbox = make_outbox(session)
+    begins = []
+    outbox._conn.set_trace_callback(lambda sql: begins.append(sql) if sql == "BEGIN" else None)
+    outbox.start()
+
+    keys = []
+    # Segura o banco para que os pedidos se acumulem e entrem no mesmo commit
+    with outbox._db_lock:
+        threads = [threading.Thread(target=lambda i=i: keys.append(outbox.enqueue({"n": i})))
+                   for i in range(50)]
+        for thread in threads:
+            thread.start()
+        wait_for(lambda: len(outbox._queue) >= 45)
+    for thread in threads:
+        thread.join()
+
+    assert len(keys) == 50
+    assert len(begins) < 10
+    wait_for(lambda: all(outbox.get(key)["status"] == "SENT" for key in keys))
+    assert {call["headers"]["x-idempotency-key"] for call in session.calls} == set(keys)
+    assert outbox.get(keys[0])["response"] == {"id": "ORDE_1"}
+
+
+def test_client_error_fails_without_retry(make_outbox):
+    session = StubSession(lambda call: StubResponse(400, {"error": "invalid"}))
+    outbox = make_outbox(session, max_attempts=5)
+
+    with outbox:
+        key = outbox.enqueue({"reference_id": "ref-1"})
+        wait_for(lambda: outbox.get(key)["status"] == "FAILED")
+
+    assert len(session.calls) == 1
+
+
+def test_server_error_is_retried_up_to_max_attempts(make_outbox):
+    session = StubSession(lambda call: StubResponse(503))
+    outbox = make_outbox(session, max_attempts=3)
+
+    with outbox:
+        key = outbox.enqueue({"reference_id": "ref-1"})
+        wait_for(lambda: outbox.get(key)["status"] == "FAILED")
+
+    assert len(session.calls) == 3
+    assert outbox.get(key)["attempts"] == 3
+
+
+def test_connection_error_is_retried_until_success(make_outbox):
+    def handler(call):
+        if call["number"] < 3:
+            raise requests.ConnectionError("connection reset")
+        return StubResponse(201, {"id": "ORDE_1"})
+
+    session = StubSession(handler)
+    outbox = make_outbox(session, max_attempts=5)
+
+    with outbox:
+        key = outbox.enqueue({"reference_id": "ref-1"})
+        wait_for(lambda: outbox.get(key)["status"] == "SENT")
+
+    assert len(session.calls) == 3
+    assert len({call["headers"]["x-idempotency-key"] for call in session.calls}) == 1
+
+
+def test_card_data_never_reaches_disk(make_outbox, tmp_path):
+    release = threading.Event()
+
+    def handler(call):
+        release.wait(5)
+        return StubResponse(201, {"id": "ORDE_1"})
+
+    session = StubSession(handler)
+    outbox = make_outbox(session)
+
+    def disk_contents():
+        return b"".join(path.read_bytes() for path in tmp_path.iterdir() if path.is_file())
+
+    with outbox:
+        key = outbox.enqueue(card_order())
+        wait_for(lambda: session.calls)
+        # Durante o envio o cartão vai para o PagBank, mas não para o disco
+        card = session.calls[0]["json"]["charges"][0]["payment_method"]["card"]
+        assert card["number"] == CARD_NUMBER
+        assert card["security_code"] == SECURITY_CODE
+        assert CARD_NUMBER.encode() not in disk_contents()
+
+        release.set()
+        wait_for(lambda: outbox.get(key)["status"] == "SENT")
+
+    assert CARD_NUMBER.encode() not in disk_contents()
+    conn = sqlite3.connect(str(tmp_path / "outbox.db"))
+    assert conn.execute("SELECT payload FROM outbox WHERE id = ?", (key,)).fetchone() == (None,)
+    assert outbox._card_secrets == {}
+
+
+def test_duplicate_key_discards_card_data(make_outbox):
+    session = StubSession()
+    outbox = make_outbox(session)
+
+    with outbox:
+        key = outbox.enqueue(card_order(), idempotency_key="order-1")
+        wait_for(lambda: outbox.get(key)["status"] == "SENT")
+        assert outbox.enqueue(card_order(), idempotency_key="order-1") == "order-1"
+
+    assert outbox._card_secrets == {}
+    assert len(session.calls) == 1
+
+
+def test_restart_replays_or_flags_unfinished_rows(make_outbox, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    make_outbox(StubSession()).close()
+    # Estado deixado por um processo que morreu no meio dos envios
+    insert_row(path, "plain-in-flight", "IN_FLIGHT", attempts=1, card_redacted=False)
+    insert_row(path, "card-in-flight", "IN_FLIGHT", attempts=1, card_redacted=True)
+    insert_row(path, "card-retrying", "PENDING", attempts=2, card_redacted=True)
+    insert_row(path, "card-never-sent", "PENDING", attempts=0, card_redacted=True)
+
+    session = StubSession()
+    outbox = make_outbox(session)
+    with outbox:
+        wait_for(lambda: outbox.get("plain-in-flight")["status"] == "SENT")
+        wait_for(lambda: outbox.get("card-never-sent")["status"] == "FAILED")
+
+    # Só o pedido sem cartão aberto é reenviado, com a mesma chave de idempotência
+    assert [call["headers"]["x-idempotency-key"] for call in session.calls] == ["plain-in-flight"]
+    assert outbox.get("card-in-flight")["status"] == "UNKNOWN"
+    assert outbox.get("card-retrying")["status"] == "UNKNOWN"
+    assert {row["reference_id"] for row in outbox.in_doubt()} == {"ref-card-in-flight",
+                                                                  "ref-card-retrying"}
+
+    outbox.reconcile("card-in-flight", {"id": "ORDE_2"})
+    outbox.reconcile("card-retrying")
+    assert outbox.get("card-in-flight")["status"] == "SENT"
+    assert outbox.get("card-in-flight")["response"] == {"id": "ORDE_2"}
+    assert outbox.get("card-retrying")["status"] == "FAILED"
+    assert outbox.in_doubt() == []
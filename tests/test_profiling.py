@@ -0,0 +1,40 @@
+import os
+import time
+
+from payments import PaymentProfiler
+
+
+def slow_stage():
+    time.sleep(0.05)
+
+
+def profiled_call(profiler):
+    with profiler.profile("process_payment"):
+        slow_stage()
+
+
+def test_stacks_start_at_profiled_block_regardless_of_call_site(tmp_path):
+    profiler = PaymentProfiler(sample_rate=1.0, interval=0.001)
+
+    def first_caller():
+        profiled_call(profiler)
+
+    def second_caller():
+        profiled_call(profiler)
+
+    first_caller()
+    second_caller()
+
+    assert profiler.stacks
+    # As duas chamadas somam na mesma pilha, sem os quadros de quem chamou
+    assert set(profiler.stacks) <= {"process_payment", "process_payment;test_profiling.py:slow_stage"}
+    assert profiler.stacks["process_payment;test_profiling.py:slow_stage"] > 0
+
+
+def test_dump_uses_pid_in_path_and_writes_empty_file(tmp_path):
+    profiler = PaymentProfiler(sample_rate=0.0, output_path=str(tmp_path / "profile.{pid}.collapsed"))
+
+    path = profiler.dump()
+
+    assert path == str(tmp_path / f"profile.{os.getpid()}.collapsed")
+    assert os.path.getsize(path) == 0